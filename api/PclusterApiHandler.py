@@ -9,19 +9,31 @@
 # OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and
 # limitations under the License.
 import functools
-import json
+import http.cookiejar
+import operator
 import os
 import re
+import threading
 import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
 import botocore
 import jose
+import orjson
 import requests
 import yaml
 from flask import abort, redirect, request
 from flask_restful import Resource, reqparse
 from jose import jwt
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    from yaml import CSafeLoader as _SafeLoader
+except ImportError:
+    from yaml import SafeLoader as _SafeLoader
 
 USER_POOL_ID = os.getenv("USER_POOL_ID")
 AUTH_PATH = os.getenv("AUTH_PATH")
@@ -32,11 +44,34 @@ CLIENT_SECRET = os.getenv("CLIENT_SECRET")
 SECRET_ID = os.getenv("SECRET_ID")
 ENABLE_MFA = os.getenv("ENABLE_MFA")
 SITE_URL = os.getenv("SITE_URL", API_BASE_URL)
+JWKS_TTL = 3600
+TOKEN_CACHE_SIZE = 4096
+TOKEN_CACHE_TTL = 60
+CLUSTER_CONFIG_CACHE_TTL = 60
+HTTP_TIMEOUT = (3, 10)
+PRICE_CACHE_TTL = 86400
+
+# Shared across users, so never persist upstream cookies and only retry requests that never reached the server
+_HTTP = requests.Session()
+_HTTP.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+_HTTP_ADAPTER = HTTPAdapter(
+    pool_connections=50, pool_maxsize=50, max_retries=Retry(total=2, read=0, status=0, backoff_factor=0.1)
+)
+_HTTP.mount("https://", _HTTP_ADAPTER)
+_HTTP.mount("http://", _HTTP_ADAPTER)
+_BOTO_SESSION = botocore.session.Session()
+_SIGNERS = {}
+_INSTANCE_FAMILIES = ("c5", "c6", "g4", "g5", "hpc", "p3", "p4", "t2", "m6", "r")
+_DCV_RE = re.compile(r"PclusterDcvServerPort=(\d+) PclusterDcvSessionId=(\w+) PclusterDcvSessionToken=([\w-]+)")
+_CLUSTER_CONFIG_CACHE = {}
+_PRICE_CACHE = {}
+_TOKEN_CACHE = {}
+_TOKEN_CACHE_LOCK = threading.Lock()
 
 try:
     if (not USER_POOL_ID or USER_POOL_ID == "") and SECRET_ID:
         secrets = boto3.client("secretsmanager")
-        secret = json.loads(secrets.get_secret_value(SecretId=SECRET_ID)["SecretString"])
+        secret = orjson.loads(secrets.get_secret_value(SecretId=SECRET_ID)["SecretString"])
         USER_POOL_ID = secret.get("userPoolId")
         CLIENT_ID = secret.get("clientId")
         CLIENT_SECRET = secret.get("clientSecret")
@@ -46,6 +81,15 @@ except Exception:
 # Helpers
 
 
+@functools.lru_cache(maxsize=64)
+def _client(service, region=None):
+    "Return a shared boto3 client for the given service and region."
+    config = botocore.config.Config(
+        region_name=region or None, max_pool_connections=50, retries={"max_attempts": 3, "mode": "adaptive"}
+    )
+    return boto3.client(service, config=config)
+
+
 def running_local():
     return not os.getenv("AWS_LAMBDA_FUNCTION_NAME")
 
@@ -54,32 +98,72 @@ def disable_auth():
     return os.getenv("ENABLE_AUTH") == "false"
 
 
-def jwt_decode(token, user_pool_id):
+@functools.lru_cache(maxsize=8)
+def _get_jwks(user_pool_id, _ttl_bucket=None):
+    "Fetch the Cognito signing keys, cached until the TTL bucket rolls over."
     region = user_pool_id.split("_")[0]
     jwks_url = "https://cognito-idp.{}.amazonaws.com/{}/" ".well-known/jwks.json".format(region, user_pool_id)
-    return jwt.decode(token, requests.get(jwks_url).json())
+    jwks_resp = _HTTP.get(jwks_url, timeout=HTTP_TIMEOUT)
+    jwks_resp.raise_for_status()
+    return orjson.loads(jwks_resp.content)
 
 
-def sigv4_request(method, host, path, params={}, headers={}, body=None):
-    "Make a signed request to an api-gateway hosting an AWS ParallelCluster API."
+def jwt_decode(token, user_pool_id):
+    return jwt.decode(token, _get_jwks(user_pool_id, int(time.time() // JWKS_TTL)))
+
+
+def _decode_access_token(token):
+    "Decode an access token, reusing the verified claims while they are still fresh."
+    now = time.time()
+    with _TOKEN_CACHE_LOCK:
+        cached = _TOKEN_CACHE.get(token)
+        if cached and cached[1] > now:
+            return cached[0]
+        _TOKEN_CACHE.pop(token, None)
+
+    decoded = jwt_decode(token, USER_POOL_ID)
+    expires_at = min(decoded.get("exp", now), now + TOKEN_CACHE_TTL)
+    with _TOKEN_CACHE_LOCK:
+        if len(_TOKEN_CACHE) >= TOKEN_CACHE_SIZE:
+            _TOKEN_CACHE.pop(next(iter(_TOKEN_CACHE)))
+        _TOKEN_CACHE[token] = (decoded, expires_at)
+    return decoded
+
+
+def _get_signer(region):
+    "Return the SigV4 signer for a region, only caching it once credentials have resolved."
+    signer = _SIGNERS.get(region)
+    if signer is None:
+        signer = botocore.auth.SigV4Auth(_BOTO_SESSION.get_credentials(), "execute-api", region)
+        if signer.credentials is not None:
+            _SIGNERS[region] = signer
+    return signer
+
+
+@functools.lru_cache(maxsize=16)
+def _host_region(host):
     endpoint = host.replace("https://", "").replace("http://", "")
     _api_id, _service, region, _domain = endpoint.split(".", maxsplit=3)
+    return region
 
-    request_parameters = "&".join([f"{k}={v}" for k, v in (params or {}).items()])
-    url = f"{host}{path}?{request_parameters}"
 
-    session = botocore.session.Session()
-    body_data = json.dumps(body) if body else None
+def sigv4_request(method, host, path, params={}, headers={}, body=None):
+    "Make a signed request to an api-gateway hosting an AWS ParallelCluster API."
+    region = _host_region(host)
+
+    url = f"{host}{path}?{urllib.parse.urlencode(params, quote_via=urllib.parse.quote)}" if params else f"{host}{path}"
+
+    body_data = orjson.dumps(body) if body else None
     new_request = botocore.awsrequest.AWSRequest(method=method, url=url, data=body_data)
-    botocore.auth.SigV4Auth(session.get_credentials(), "execute-api", region).add_auth(new_request)
+    _get_signer(region).add_auth(new_request)
     boto_request = new_request.prepare()
 
     req_call = {
-        "POST": requests.post,
-        "GET": requests.get,
-        "PUT": requests.put,
-        "PATCH": requests.patch,
-        "DELETE": requests.delete,
+        "POST": _HTTP.post,
+        "GET": _HTTP.get,
+        "PUT": _HTTP.put,
+        "PATCH": _HTTP.patch,
+        "DELETE": _HTTP.delete,
     }.get(method)
 
     if body:
@@ -108,7 +192,7 @@ def authenticate(group):
     if not access_token:
         return auth_redirect()
     try:
-        decoded = jwt_decode(access_token, USER_POOL_ID)
+        decoded = _decode_access_token(access_token)
     except jwt.ExpiredSignatureError:
         return auth_redirect()
     except jose.exceptions.JWSSignatureError:
@@ -139,20 +223,17 @@ def get_version():
 
 
 def ec2_action():
-    if request.args.get("region"):
-        config = botocore.config.Config(region_name=request.args.get("region"))
-        ec2 = boto3.client("ec2", config=config)
-    else:
-        ec2 = boto3.client("ec2")
+    ec2 = _client("ec2", request.args.get("region"))
+    action = request.args.get("action")
 
     try:
         instance_ids = request.args.get("instance_ids").split(",")
     except:
         return {"message": "You must specify instances."}, 400
 
-    if request.args.get("action") == "stop_instances":
+    if action == "stop_instances":
         resp = ec2.stop_instances(InstanceIds=instance_ids)
-    elif request.args.get("action") == "start_instances":
+    elif action == "start_instances":
         resp = ec2.start_instances(InstanceIds=instance_ids)
     else:
         return {"message": "You must specify an action."}, 400
@@ -162,6 +243,12 @@ def ec2_action():
     return ret
 
 
+def _fetch_configuration(url):
+    configuration = _HTTP.get(url, timeout=HTTP_TIMEOUT)
+    configuration.raise_for_status()
+    return configuration.text
+
+
 def get_cluster_config_text(cluster_name, region=None):
     url = f"/v3/clusters/{cluster_name}"
     if region:
@@ -169,26 +256,47 @@ def get_cluster_config_text(cluster_name, region=None):
     else:
         info_resp = sigv4_request("GET", API_BASE_URL, url)
     if info_resp.status_code != 200:
-        print(info_resp.json())
-        return info_resp.json(), info_resp.status_code
-    cluster_info = info_resp.json()
-    configuration = requests.get(cluster_info["clusterConfiguration"]["url"])
-    return configuration.text
+        error = orjson.loads(info_resp.content)
+        print(error)
+        return error, info_resp.status_code
+    cluster_info = orjson.loads(info_resp.content)
+    return _fetch_configuration(cluster_info["clusterConfiguration"]["url"])
+
+
+def _cached_cluster_config_text(cluster_name, region):
+    "Return the cluster configuration, reusing a copy fetched within the last CLUSTER_CONFIG_CACHE_TTL seconds."
+    cached = _CLUSTER_CONFIG_CACHE.get((cluster_name, region))
+    if cached and time.time() - cached[1] < CLUSTER_CONFIG_CACHE_TTL:
+        return cached[0]
+    config_text = get_cluster_config_text(cluster_name, region)
+    if not isinstance(config_text, tuple):
+        _CLUSTER_CONFIG_CACHE[(cluster_name, region)] = (config_text, time.time())
+    return config_text
 
 
 def get_cluster_config():
     return get_cluster_config_text(request.args.get("cluster_name"), request.args.get("region"))
 
 
+def _wait_for_command(ssm, command_id, instance_id, timeout):
+    "Wait for an SSM command to leave the pending states, returning its last invocation."
+    waiter = ssm.get_waiter("command_executed")
+    try:
+        waiter.wait(CommandId=command_id, InstanceId=instance_id, WaiterConfig={"Delay": 1, "MaxAttempts": timeout})
+    except botocore.exceptions.WaiterError as e:
+        if "Status" not in e.last_response and "Max attempts exceeded" not in str(e):
+            raise
+        return e.last_response
+    return ssm.get_command_invocation(CommandId=command_id, InstanceId=instance_id)
+
+
+def _command_pending(status):
+    return status.get("Status", "Pending") in {"Pending", "InProgress", "Delayed"}
+
+
 def ssm_command(region, instance_id, user, run_command):
     # working_directory |= f"/home/{user}"
-    start = time.time()
-
-    if region:
-        config = botocore.config.Config(region_name=region)
-        ssm = boto3.client("ssm", config=config)
-    else:
-        ssm = boto3.client("ssm")
+    ssm = _client("ssm", region)
 
     command = f"runuser -l {user} -c '{run_command}'"
 
@@ -202,14 +310,9 @@ def ssm_command(region, instance_id, user, run_command):
     command_id = ssm_resp["Command"]["CommandId"]
 
     # Wait for command to complete
-    time.sleep(0.75)
-    while time.time() - start < 60:
-        status = ssm.get_command_invocation(CommandId=command_id, InstanceId=instance_id)
-        if status["Status"] != "InProgress":
-            break
-        time.sleep(0.75)
-
-    if time.time() - start > 60:
+    status = _wait_for_command(ssm, command_id, instance_id, timeout=60)
+
+    if _command_pending(status):
         return {"message": "Timed out waiting for command to complete."}, 500
 
     if status["Status"] != "Success":
@@ -220,6 +323,7 @@ def ssm_command(region, instance_id, user, run_command):
 
 
 def submit_job():
+    region = request.args.get("region")
     user = request.args.get("user", "ec2-user")
     instance_id = request.args.get("instance_id")
     body = request.json
@@ -232,15 +336,43 @@ def submit_job():
 
     print(job_cmd)
 
-    resp = ssm_command(request.args.get("region"), instance_id, user, f"sbatch {job_cmd}")
+    resp = ssm_command(region, instance_id, user, f"sbatch {job_cmd}")
     print(resp)
 
-    return resp if type(resp) == tuple else {"success": "true"}
+    return resp if isinstance(resp, tuple) else {"success": "true"}
+
+
+def _instance_price(instance_type, region):
+    "Look up the on-demand Linux price of an instance type, cached for PRICE_CACHE_TTL seconds."
+    cached = _PRICE_CACHE.get((instance_type, region))
+    if cached and time.time() - cached[1] < PRICE_CACHE_TTL:
+        return cached[0]
+
+    pricing_filters = [
+        {"Field": "tenancy", "Value": "shared", "Type": "TERM_MATCH"},
+        {"Field": "instanceType", "Value": instance_type, "Type": "TERM_MATCH"},
+        {"Field": "operatingSystem", "Value": "Linux", "Type": "TERM_MATCH"},
+        {"Field": "regionCode", "Value": region, "Type": "TERM_MATCH"},
+        {"Field": "preInstalledSw", "Value": "NA", "Type": "TERM_MATCH"},
+        {"Field": "capacityStatus", "Value": "Used", "Type": "TERM_MATCH"},
+    ]
+
+    # Pricing endpoint only available from "us-east-1" region
+    pricing = _client("pricing", "us-east-1")
+    prices = pricing.get_products(ServiceCode="AmazonEC2", Filters=pricing_filters)["PriceList"]
+    prices = list(map(orjson.loads, prices))
+    on_demand_prices = list(prices[0]["terms"]["OnDemand"].values())
+    price_guess = float(list(on_demand_prices[0]["priceDimensions"].values())[0]["pricePerUnit"]["USD"])
+    price_guess = None if price_guess != price_guess else price_guess  # check for NaN
+    _PRICE_CACHE[(instance_type, region)] = (price_guess, time.time())
+    return price_guess
 
 
 def _price_estimate(cluster_name, region, queue_name):
-    config_text = get_cluster_config_text(cluster_name, region)
-    config_data = yaml.safe_load(config_text)
+    config_text = _cached_cluster_config_text(cluster_name, region)
+    if isinstance(config_text, tuple):
+        return config_text
+    config_data = yaml.load(config_text, Loader=_SafeLoader)
     queues = {q["Name"]: q for q in config_data["Scheduling"]["SlurmQueues"]}
     queue = queues[queue_name]
 
@@ -248,23 +380,7 @@ def _price_estimate(cluster_name, region, queue_name):
         instance_type = queue["ComputeResources"][0]["InstanceType"]
         print("****************************************************")
         print("instance type", instance_type)
-        pricing_filters = [
-            {"Field": "tenancy", "Value": "shared", "Type": "TERM_MATCH"},
-            {"Field": "instanceType", "Value": instance_type, "Type": "TERM_MATCH"},
-            {"Field": "operatingSystem", "Value": "Linux", "Type": "TERM_MATCH"},
-            {"Field": "regionCode", "Value": region, "Type": "TERM_MATCH"},
-            {"Field": "preInstalledSw", "Value": "NA", "Type": "TERM_MATCH"},
-            {"Field": "capacityStatus", "Value": "Used", "Type": "TERM_MATCH"},
-        ]
-
-        # Pricing endpoint only available from "us-east-1" region
-        pricing = boto3.client("pricing", region_name="us-east-1")
-        prices = pricing.get_products(ServiceCode="AmazonEC2", Filters=pricing_filters)["PriceList"]
-        prices = list(map(json.loads, prices))
-        on_demand_prices = list(prices[0]["terms"]["OnDemand"].values())
-        price_guess = float(list(on_demand_prices[0]["priceDimensions"].values())[0]["pricePerUnit"]["USD"])
-        price_guess = None if price_guess != price_guess else price_guess  # check for NaN
-        return price_guess
+        return _instance_price(instance_type, region)
     else:
         return {"message": "Cost estimate not available for queues with multiple resource types."}, 400
 
@@ -277,6 +393,7 @@ def price_estimate():
 
 
 def scontrol_job():
+    region = request.args.get("region")
     user = request.args.get("user", "ec2-user")
     instance_id = request.args.get("instance_id")
     job_id = request.args.get("job_id")
@@ -284,51 +401,46 @@ def scontrol_job():
     if not job_id:
         return {"message": "You must specify a job id."}, 400
 
-    job_data = (
-        ssm_command(request.args.get("region"), instance_id, user, f"scontrol show job {job_id} -o").strip().split(" ")
-    )
+    job_data = ssm_command(region, instance_id, user, f"scontrol show job {job_id} -o")
     if isinstance(job_data, tuple):
         return job_data
 
-    kvs = [jd.split("=", 1) for jd in job_data]
-    job_info = {k: v for k, v in kvs}
+    job_info = dict(jd.split("=", 1) for jd in job_data.strip().split(" ") if jd)
     return job_info
 
 
 def queue_status():
+    region = request.args.get("region")
     user = request.args.get("user", "ec2-user")
     instance_id = request.args.get("instance_id")
 
     jobs = ssm_command(
-        request.args.get("region"),
+        region,
         instance_id,
         user,
         "squeue --json | jq .jobs\\|\\map\\({name,nodes,partition,job_state,job_id,time\\}\\)",
     )
 
-    return {"jobs": []} if jobs == "" else {"jobs": json.loads(jobs)}
+    return {"jobs": []} if jobs == "" else {"jobs": orjson.loads(jobs)}
 
 
 def cancel_job():
+    region = request.args.get("region")
     user = request.args.get("user", "ec2-user")
     instance_id = request.args.get("instance_id")
     job_id = request.args.get("job_id")
-    ssm_command(request.args.get("region"), instance_id, user, f"scancel {job_id}")
+    ssm_command(region, instance_id, user, f"scancel {job_id}")
     return {"status": "success"}
 
 
 def get_dcv_session():
-    start = time.time()
+    region = request.args.get("region")
     user = request.args.get("user", "ec2-user")
     instance_id = request.args.get("instance_id")
     dcv_command = "/opt/parallelcluster/scripts/pcluster_dcv_connect.sh"
     session_directory = f"/home/{user}"
 
-    if request.args.get("region"):
-        config = botocore.config.Config(region_name=request.args.get("region"))
-        ssm = boto3.client("ssm", config=config)
-    else:
-        ssm = boto3.client("ssm")
+    ssm = _client("ssm", region)
 
     command = f"runuser -l {user} -c '{dcv_command} {session_directory}'"
 
@@ -342,14 +454,9 @@ def get_dcv_session():
     command_id = ssm_resp["Command"]["CommandId"]
 
     # Wait for command to complete
-    time.sleep(0.75)
-    while time.time() - start < 15:
-        status = ssm.get_command_invocation(CommandId=command_id, InstanceId=instance_id)
-        if status["Status"] != "InProgress":
-            break
-        time.sleep(0.75)
-
-    if time.time() - start > 15:
+    status = _wait_for_command(ssm, command_id, instance_id, timeout=15)
+
+    if _command_pending(status):
         return {"message": "Timed out waiting for dcv session to start."}, 500
 
     if status["Status"] != "Success":
@@ -357,9 +464,7 @@ def get_dcv_session():
 
     output = status["StandardOutputContent"]
 
-    dcv_parameters = re.search(
-        r"PclusterDcvServerPort=([\d]+) PclusterDcvSessionId=([\w]+) PclusterDcvSessionToken=([\w-]+)", output
-    )
+    dcv_parameters = _DCV_RE.search(output)
 
     if not dcv_parameters:
         return {"message": "Something went wrong during DCV connection. Check logs in /var/log/parallelcluster/ ."}, 500
@@ -373,88 +478,86 @@ def get_dcv_session():
 
 
 def get_custom_image_config():
-    image_info = sigv4_request("GET", API_BASE_URL, f"/v3/images/custom/{request.args.get('image_id')}").json()
-    configuration = requests.get(image_info["imageConfiguration"]["url"])
-    return configuration.text
-
+    image_resp = sigv4_request("GET", API_BASE_URL, f"/v3/images/custom/{request.args.get('image_id')}")
+    image_info = orjson.loads(image_resp.content)
+    return _fetch_configuration(image_info["imageConfiguration"]["url"])
 
-def get_aws_config():
-    if request.args.get("region"):
-        config = botocore.config.Config(region_name=args.get("region"))
-        ec2 = boto3.client("ec2", config=config)
-        fsx = boto3.client("fsx", config=config)
-        efs = boto3.client("efs", config=config)
-    else:
-        ec2 = boto3.client("ec2")
-        fsx = boto3.client("fsx")
-        efs = boto3.client("efs")
-
-    keypairs = ec2.describe_key_pairs()["KeyPairs"]
-    vpcs = ec2.describe_vpcs()["Vpcs"]
-    subnets = ec2.describe_subnets()["Subnets"]
-
-    security_groups = ec2.describe_security_groups()["SecurityGroups"]
-    security_groups = [{k: sg[k] for k in {"GroupId", "GroupName"}} for sg in security_groups]
 
+def _efa_instance_types(ec2):
     efa_filters = [{"Name": "network-info.efa-supported", "Values": ["true"]}]
     instance_paginator = ec2.get_paginator("describe_instance_types")
     efa_instances_paginator = instance_paginator.paginate(Filters=efa_filters)
-    efa_instance_types = []
-    for efa_instances in efa_instances_paginator:
-        efa_instance_types += [e["InstanceType"] for e in efa_instances["InstanceTypes"]]
+    return [e["InstanceType"] for efa_instances in efa_instances_paginator for e in efa_instances["InstanceTypes"]]
 
-    fsx_filesystems = []
-    try:
-        fsx_filesystems = fsx.describe_file_systems()["FileSystems"]
-    except:
-        pass
 
-    efs_filesystems = []
+def _or_empty(describe):
     try:
-        efs_filesystems = efs.describe_file_systems()["FileSystems"]
+        return describe()
     except:
-        pass
+        return []
+
 
-    region = ""
+def get_aws_config():
+    region = request.args.get("region")
+    ec2 = _client("ec2", region)
+    fsx = _client("fsx", region)
+    efs = _client("efs", region)
+
+    describe_calls = {
+        "keypairs": lambda: ec2.describe_key_pairs()["KeyPairs"],
+        "vpcs": lambda: ec2.describe_vpcs()["Vpcs"],
+        "subnets": lambda: ec2.describe_subnets()["Subnets"],
+        "security_groups": lambda: ec2.describe_security_groups()["SecurityGroups"],
+        "efa_instance_types": lambda: _efa_instance_types(ec2),
+        "fsx_filesystems": lambda: _or_empty(lambda: fsx.describe_file_systems()["FileSystems"]),
+        "efs_filesystems": lambda: _or_empty(lambda: efs.describe_file_systems()["FileSystems"]),
+    }
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        futures = {name: executor.submit(describe) for name, describe in describe_calls.items()}
+    results = {name: future.result() for name, future in futures.items()}
+
+    security_groups = [{k: sg[k] for k in {"GroupId", "GroupName"}} for sg in results["security_groups"]]
+
+    default_region = ""
     try:
-        region = boto3.Session().region_name
+        default_region = boto3.Session().region_name
     except:
         pass
 
     return {
         "security_groups": security_groups,
-        "keypairs": keypairs,
-        "vpcs": vpcs,
-        "subnets": subnets,
-        "region": region,
-        "fsx_filesystems": fsx_filesystems,
-        "efs_filesystems": efs_filesystems,
-        "efa_instance_types": efa_instance_types,
+        "keypairs": results["keypairs"],
+        "vpcs": results["vpcs"],
+        "subnets": results["subnets"],
+        "region": default_region,
+        "fsx_filesystems": results["fsx_filesystems"],
+        "efs_filesystems": results["efs_filesystems"],
+        "efa_instance_types": results["efa_instance_types"],
     }
 
 
 def get_instance_types():
-    if request.args.get("region"):
-        config = botocore.config.Config(region_name=args.get("region"))
-        ec2 = boto3.client("ec2", config=config)
-    else:
-        ec2 = boto3.client("ec2")
+    region = request.args.get("region")
+    ec2 = _client("ec2", region)
     filters = [
         {"Name": "current-generation", "Values": ["true"]},
-        {"Name": "instance-type", "Values": ["c5*", "c6*", "g4*", "g5*", "hpc*", "p3*", "p4*", "t2*", "m6*", "r*"]},
+        {"Name": "instance-type", "Values": [f"{family}*" for family in _INSTANCE_FAMILIES]},
     ]
     instance_paginator = ec2.get_paginator("describe_instance_types")
     instances_paginator = instance_paginator.paginate(Filters=filters)
-    instance_types = []
-    for ec2_instances in instances_paginator:
-        for e in ec2_instances["InstanceTypes"]:
-            ret_e = {"InstanceType": e["InstanceType"]}
-            ret_e["NetworkInfo"] = {"EfaSupported": e["NetworkInfo"].get("EfaSupported", False)}
-            ret_e["MemoryInfo"] = e["MemoryInfo"]
-            ret_e["VCpuInfo"] = {"DefaultVCpus": e["VCpuInfo"]["DefaultVCpus"]}
-            ret_e["GpuInfo"] = e.get("GpuInfo", {"Gpus": [{}]})["Gpus"][0]
-            instance_types.append(ret_e)
-    return {"instance_types": sorted(instance_types, key=lambda x: x["InstanceType"])}
+    instance_types = [
+        {
+            "InstanceType": e["InstanceType"],
+            "NetworkInfo": {"EfaSupported": e["NetworkInfo"].get("EfaSupported", False)},
+            "MemoryInfo": e["MemoryInfo"],
+            "VCpuInfo": {"DefaultVCpus": e["VCpuInfo"]["DefaultVCpus"]},
+            "GpuInfo": e.get("GpuInfo", {"Gpus": [{}]})["Gpus"][0],
+        }
+        for ec2_instances in instances_paginator
+        for e in ec2_instances["InstanceTypes"]
+        if e["InstanceType"].startswith(_INSTANCE_FAMILIES)
+    ]
+    return {"instance_types": sorted(instance_types, key=operator.itemgetter("InstanceType"))}
 
 
 def get_identity():
@@ -468,7 +571,7 @@ def get_identity():
         decoded = jwt_decode(access_token, USER_POOL_ID)
         username = decoded.get("username")
         if username:
-            cognito = boto3.client("cognito-idp")
+            cognito = _client("cognito-idp")
             filter_ = f'username = "{username}"'
             user = cognito.list_users(UserPoolId=USER_POOL_ID, Filter=filter_)["Users"][0]
             decoded["attributes"] = {ua["Name"]: ua["Value"] for ua in user["Attributes"]}
@@ -481,28 +584,57 @@ def get_identity():
     return decoded
 
 
-def _augment_user(cognito, user):
-    try:
-        groups_list = cognito.admin_list_groups_for_user(UserPoolId=USER_POOL_ID, Username=user["Username"])
-        user["Groups"] = groups_list["Groups"]
-    except Exception as e:
-        user["exception"] = str(e)
+def _augment_user(cognito, user, groups=None):
+    if groups is not None:
+        user["Groups"] = groups
+    else:
+        try:
+            groups_list = cognito.admin_list_groups_for_user(UserPoolId=USER_POOL_ID, Username=user["Username"])
+            user["Groups"] = groups_list["Groups"]
+        except Exception as e:
+            user["exception"] = str(e)
     user["Attributes"] = {ua["Name"]: ua["Value"] for ua in user["Attributes"]}
     return user
 
 
+def _group_members(cognito, group_name):
+    paginator = cognito.get_paginator("list_users_in_group")
+    pages = paginator.paginate(UserPoolId=USER_POOL_ID, GroupName=group_name)
+    return [user["Username"] for page in pages for user in page["Users"]]
+
+
+def _user_groups(cognito):
+    "Map each username to its groups with one Cognito call per group."
+    group_pages = cognito.get_paginator("list_groups").paginate(UserPoolId=USER_POOL_ID)
+    groups = [group for page in group_pages for group in page["Groups"]]
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        members = list(executor.map(lambda group: _group_members(cognito, group["GroupName"]), groups))
+
+    user_groups = {}
+    for group, usernames in zip(groups, members):
+        for username in usernames:
+            user_groups.setdefault(username, []).append(group)
+    return user_groups
+
+
 def list_users():
     try:
-        cognito = boto3.client("cognito-idp")
+        cognito = _client("cognito-idp")
         users = cognito.list_users(UserPoolId=USER_POOL_ID)["Users"]
-        return {"users": [_augment_user(cognito, user) for user in users]}
+        try:
+            user_groups = _user_groups(cognito)
+        except Exception as e:
+            print(f"Falling back to per-user group lookups: {e}")
+            with ThreadPoolExecutor(max_workers=16) as executor:
+                return {"users": list(executor.map(lambda user: _augment_user(cognito, user), users))}
+        return {"users": [_augment_user(cognito, user, user_groups.get(user["Username"], [])) for user in users]}
     except Exception as e:
         return {"exception": str(e)}
 
 
 def delete_user():
     try:
-        cognito = boto3.client("cognito-idp")
+        cognito = _client("cognito-idp")
         username = request.args.get("username")
         cognito.admin_delete_user(UserPoolId=USER_POOL_ID, Username=username)
         return {"Username": username}
@@ -512,7 +644,7 @@ def delete_user():
 
 def create_user():
     try:
-        cognito = boto3.client("cognito-idp")
+        cognito = _client("cognito-idp")
         username = request.json.get("Username")
         phone_number = request.json.get("Phonenumber")
         user_attributes = [{"Name": "email", "Value": username}]
@@ -527,7 +659,7 @@ def create_user():
 
 
 def set_user_role():
-    cognito = boto3.client("cognito-idp")
+    cognito = _client("cognito-idp")
     username = request.json["username"]
     role = request.json["role"]
     print(f"setting {username} => {role}")
@@ -559,14 +691,14 @@ def login():
     grant_type = "authorization_code"
 
     url = f"{AUTH_PATH}/oauth2/token"
-    code_resp = requests.post(
+    code_resp = _HTTP.post(
         url,
         data={"grant_type": grant_type, "code": code, "client_id": CLIENT_ID, "redirect_uri": redirect_uri},
         auth=auth,
         headers={"Content-Type": "application/x-www-form-urlencoded"},
     )
 
-    access_token = code_resp.json().get("access_token")
+    access_token = orjson.loads(code_resp.content).get("access_token")
     if not access_token:
         return redirect(auth_redirect_path, code=302)
 
@@ -583,43 +715,38 @@ def logout():
 
 
 def _get_params(_request):
-    params = {**_request.args}
-    params.pop("path")
-    return params
+    return {k: v for k, v in _request.args.items() if k != "path"}
 
 
 # Proxy
 
 
 class PclusterApiHandler(Resource):
-    method_decorators = [authenticated("user", redirect=False)]
+    method_decorators = {
+        "get": [authenticated("user", redirect=False)],
+        "head": [authenticated("user", redirect=False)],
+        "post": [authenticated("admin", redirect=False)],
+        "put": [authenticated("admin", redirect=False)],
+        "delete": [authenticated("admin", redirect=False)],
+        "patch": [authenticated("admin", redirect=False)],
+    }
 
     def get(self):
         # if re.match(r".*images.*logstreams/+", args["path"]):
         #    left, right = args["path"].split("logstreams")
         #    args["path"] = "{}logstreams/{}".format(left, right[1:].replace("/", "%2F"))
         response = sigv4_request("GET", API_BASE_URL, request.args.get("path"), _get_params(request))
-        return response.json(), response.status_code
+        return orjson.loads(response.content), response.status_code
 
     def post(self):
-        auth_response = authenticate("admin")
-        if auth_response:
-            abort(401)
         resp = sigv4_request("POST", API_BASE_URL, request.args.get("path"), _get_params(request), body=request.json)
-        return resp.json(), resp.status_code
+        return orjson.loads(resp.content), resp.status_code
 
     def put(self):
-        auth_response = authenticate("admin")
-        if auth_response:
-            abort(401)
         resp = sigv4_request("PUT", API_BASE_URL, request.args.get("path"), _get_params(request), body=request.json)
-        return resp.json(), resp.status_code
+        return orjson.loads(resp.content), resp.status_code
 
     def delete(self):
-        auth_response = authenticate("admin")
-        if auth_response:
-            abort(401)
-
         body = None
         try:
             if "Content-Type" in request.headers and request.headers.get("ContentType") == "application/json":
@@ -629,11 +756,8 @@ class PclusterApiHandler(Resource):
             raise e
 
         resp = sigv4_request("DELETE", API_BASE_URL, request.args.get("path"), _get_params(request), body=body)
-        return resp.json(), resp.status_code
+        return orjson.loads(resp.content), resp.status_code
 
     def patch(self):
-        auth_response = authenticate("admin")
-        if auth_response:
-            abort(401)
         resp = sigv4_request("PATCH", API_BASE_URL, request.args.get("path"), _get_params(request), body=request.json)
-        return resp.json(), resp.status_code
+        return orjson.loads(resp.content), resp.status_code